@@ -18,16 +18,16 @@ __license__ = 'BSD'
 __copyright__ = '(c) 2011 by Max Countryman'
 __all__ = ['SeaSurf']
 
-import calendar
-import hashlib
-import random
+import functools
+import re
+import sys
+import time
 
-from datetime import datetime, timedelta
-import urllib.parse as urlparse
+from datetime import timedelta
+from secrets import token_hex
 
-from flask import (_app_ctx_stack, current_app, g, has_request_context, request,
-                   session)
-from werkzeug.exceptions import BadRequest, Forbidden
+from flask import current_app, g, has_request_context, request, session
+from werkzeug.exceptions import Forbidden
 
 try:
     from hmac import compare_digest as safe_str_cmp
@@ -35,25 +35,76 @@ except ImportError:
     from werkzeug.security import safe_str_cmp
 
 
-_MAX_CSRF_KEY = 2 << 63
-
-
-if hasattr(random, 'SystemRandom'):
-    random = random.SystemRandom()
-else:
-    random = random
-
-try:
-    import secrets
-except ImportError:
-    secrets = None
-
 REASON_NO_REFERER = u'Referer checking failed: no referer.'
 REASON_BAD_REFERER = u'Referer checking failed: {0} does not match {1}.'
 REASON_NO_CSRF_TOKEN = u'CSRF token not set.'
 REASON_BAD_TOKEN = u'CSRF token missing or incorrect.'
 REASON_NO_REQUEST = u'CSRF validation can only happen within a request context.'
 
+_MISSING = object()
+
+_SAFE_METHODS = frozenset(('GET', 'HEAD', 'OPTIONS', 'TRACE'))
+
+
+def _view_location(view_func):
+    '''
+    Return the dotted `module.name` location of a view function.
+
+    :param view_func: A view function.
+    '''
+    return '{0}.{1}'.format(view_func.__module__, view_func.__name__)
+
+
+def _is_registered(view_func, views, view_locations):
+    '''
+    Determine if a view function was registered with one of the view
+    decorators. Views are looked up by identity first, then by their
+    `module.name` location, as the object Flask dispatches to may not be the
+    decorated one, e.g. a second `as_view` of the same class or a wrapper.
+
+    :param view_func: A view function.
+    :param views: The set of registered view functions.
+    :param view_locations: The locations of the registered view functions.
+    '''
+    if view_func in views:
+        return True
+    return _view_location(view_func) in view_locations
+
+
+def _origin(url):
+    '''
+    Extract the `(scheme, hostname, port)` origin of a URL. Only the
+    authority is examined, the path, query and fragment are never parsed.
+    Raises :class:`ValueError` if the URL has no host or an invalid port.
+
+    :param url: The URL to extract the origin from.
+    '''
+    scheme, sep, rest = url.partition('://')
+    if not sep:
+        raise ValueError('URL has no authority')
+
+    for delimiter in '/?#':
+        rest = rest.partition(delimiter)[0]
+    hostinfo = rest.rpartition('@')[2]
+
+    if hostinfo.startswith('['):
+        hostname, _, port = hostinfo[1:].partition(']')
+        port = port.partition(':')[2]
+    else:
+        hostname, _, port = hostinfo.partition(':')
+
+    if not hostname:
+        raise ValueError('URL has no host')
+
+    if port:
+        if not (port.isascii() and port.isdigit()) or int(port) > 65535:
+            raise ValueError('Port out of range 0-65535')
+        port = int(port)
+    else:
+        port = None
+
+    return scheme.lower(), hostname.lower(), port
+
 
 def _same_origin(url1, url2):
     '''
@@ -63,10 +114,7 @@ def _same_origin(url1, url2):
     :param url2: The second URL to compare.
     '''
     try:
-        p1, p2 = urlparse.urlparse(url1), urlparse.urlparse(url2)
-        origin1 = p1.scheme, p1.hostname, p1.port
-        origin2 = p2.scheme, p2.hostname, p2.port
-        return origin1 == origin2
+        return _origin(url1) == _origin(url2)
     except ValueError:
         return False
 
@@ -77,9 +125,7 @@ class SeaSurf(object):
     this extension is to generate and validate CSRF tokens. The design and
     implementation of this extension is influenced by Django's CSRF middleware.
 
-    Tokens are generated using a salted SHA1 hash. The salt is based off
-    a random range. The OS's SystemRandom is used if available, otherwise
-    the core random.randrange is used.
+    Tokens are generated using the PEP 506 :mod:`secrets` module.
 
     You might intialize :class:`SeaSurf` something like this::
 
@@ -114,11 +160,19 @@ class SeaSurf(object):
 
     def __init__(self, app=None):
         self._exempt_views = set()
+        self._exempt_view_locations = set()
         self._include_views = set()
+        self._include_view_locations = set()
         self._set_cookie_views = set()
+        self._set_cookie_view_locations = set()
         self._exempt_urls = tuple()
+        self._exempt_urls_re = None
         self._disable_cookie = None
         self._skip_validation = None
+        # Classifying a view only depends on the decorated views, so memoize
+        # it per view function. Cleared whenever those change.
+        self._classify_view = functools.lru_cache(maxsize=4096)(
+            self._classify_view)
 
         if app is not None:
             self.init_app(app)
@@ -137,13 +191,17 @@ class SeaSurf(object):
         # Expose the CSRF token to the template.
         app.jinja_env.globals['csrf_token'] = self._get_token
 
-        self._csrf_name = app.config.get('CSRF_COOKIE_NAME', '_csrf_token')
-        self._csrf_header_name = app.config.get('CSRF_HEADER_NAME',
-                                                'X-CSRFToken')
+        # The names are used as keys into the session, cookies, form and
+        # headers on every request, so intern them.
+        self._csrf_name = sys.intern(app.config.get('CSRF_COOKIE_NAME',
+                                                    '_csrf_token'))
+        self._csrf_header_name = sys.intern(app.config.get('CSRF_HEADER_NAME',
+                                                           'X-CSRFToken'))
         self._csrf_disable = app.config.get('CSRF_DISABLE',
                                             app.config.get('TESTING', False))
         self._csrf_timeout = app.config.get('CSRF_COOKIE_TIMEOUT',
                                             timedelta(days=5))
+        self._csrf_timeout_seconds = int(self._csrf_timeout.total_seconds())
         self._csrf_secure = app.config.get('CSRF_COOKIE_SECURE', False)
         self._csrf_httponly = app.config.get('CSRF_COOKIE_HTTPONLY', False)
         self._csrf_path = app.config.get('CSRF_COOKIE_PATH', '/')
@@ -152,6 +210,24 @@ class SeaSurf(object):
         self._check_referer = app.config.get('CSRF_CHECK_REFERER', True)
         self._type = app.config.get('SEASURF_INCLUDE_OR_EXEMPT_VIEWS',
                                     'exempt')
+        self._classify_view.cache_clear()
+
+        # Only the token and expiry vary between responses, so bind the rest
+        # of the cookie settings once.
+        csrf_name = self._csrf_name
+        secure = self._csrf_secure
+        httponly = self._csrf_httponly
+        path = self._csrf_path
+        domain = self._csrf_domain
+        samesite = self._csrf_samesite
+
+        def set_cookie(response, csrf_token, max_age, expires):
+            response.set_cookie(csrf_name, csrf_token, max_age=max_age,
+                                expires=expires, secure=secure,
+                                httponly=httponly, path=path, domain=domain,
+                                samesite=samesite)
+
+        self._set_cookie_fast = set_cookie
 
         return self
 
@@ -171,12 +247,35 @@ class SeaSurf(object):
         :param view: The view to be wrapped by the decorator.
         '''
 
-        view_location = '{0}.{1}'.format(view.__module__, view.__name__)
-        self._exempt_views.add(view_location)
+        self._exempt_views.add(view)
+        self._exempt_view_locations.add(_view_location(view))
+        self._classify_view.cache_clear()
         return view
 
     def exempt_urls(self, urls):
-        self._exempt_urls = urls
+        '''
+        Exclude all URLs starting with any of the given prefixes from CSRF
+        validation.
+
+        :param urls: A tuple of URL prefixes.
+        '''
+        if isinstance(urls, str):
+            urls = (urls,)
+        self._exempt_urls = tuple(urls)
+
+        # Match every prefix in a single pass rather than one comparison per
+        # prefix. Prefixes already covered by a shorter prefix can never
+        # change the outcome, so leave them out of the pattern.
+        prefixes = []
+        for url in sorted(set(self._exempt_urls)):
+            if not (prefixes and url.startswith(prefixes[-1])):
+                prefixes.append(url)
+
+        if prefixes:
+            pattern = '|'.join(re.escape(url) for url in prefixes)
+            self._exempt_urls_re = re.compile(u'(?:{0})'.format(pattern))
+        else:
+            self._exempt_urls_re = None
 
     def include(self, view):
         '''
@@ -195,8 +294,9 @@ class SeaSurf(object):
         :param view: The view to be wrapped by the decorator.
         '''
 
-        view_location = '{0}.{1}'.format(view.__module__, view.__name__)
-        self._include_views.add(view_location)
+        self._include_views.add(view)
+        self._include_view_locations.add(_view_location(view))
+        self._classify_view.cache_clear()
         return view
 
     def disable_cookie(self, callback):
@@ -242,8 +342,8 @@ class SeaSurf(object):
         :param view: The view to be wrapped by the decorator.
         '''
 
-        view_location = '{0}.{1}'.format(view.__module__, view.__name__)
-        self._set_cookie_views.add(view_location)
+        self._set_cookie_views.add(view)
+        self._set_cookie_view_locations.add(_view_location(view))
         return view
 
     def skip_validation(self, callback):
@@ -298,14 +398,18 @@ class SeaSurf(object):
         # view was exemp, but validate was called manually in the view
         g.csrf_validation_checked = True
 
-        server_csrf_token = session.get(self._csrf_name, None)
+        # Reuse the token _before_request already read from the session, if
+        # it ran for this request and the session hasn't changed since, e.g.
+        # a view that clears the session before validating manually.
+        server_csrf_token = g.get('_csrf_server_token', _MISSING)
+        if server_csrf_token is _MISSING or session.modified:
+            server_csrf_token = session.get(self._csrf_name, None)
 
         if request.is_secure and self._check_referer:
             referer = request.headers.get('Referer')
             if referer is None:
-                error = (REASON_NO_REFERER, request.path)
-                error = u'Forbidden ({0}): {1}'.format(*error)
-                current_app.logger.warning(error)
+                current_app.logger.warning(u'Forbidden (%s): %s',
+                                           REASON_NO_REFERER, request.path)
                 raise Forbidden(description=REASON_NO_REFERER)
 
             # By setting the Access-Control-Allow-Origin header, browsers
@@ -315,35 +419,33 @@ class SeaSurf(object):
             # request before it got here.
             allowed_referer = request.headers.get('Origin') or request.url_root
             if not _same_origin(referer, allowed_referer):
-                error = REASON_BAD_REFERER.format(referer, allowed_referer)
-                description = error
-                error = (error, request.path)
-                error = u'Forbidden ({0}): {1}'.format(*error)
-                current_app.logger.warning(error)
+                description = REASON_BAD_REFERER.format(referer,
+                                                        allowed_referer)
+                current_app.logger.warning(u'Forbidden (%s): %s',
+                                           description, request.path)
                 raise Forbidden(description=description)
 
-        request_csrf_token = request.form.get(self._csrf_name, '')
-        if not request_csrf_token:
-            # Check to see if the data is being sent as JSON
-            try:
-                if hasattr(request, 'is_json') and request.is_json \
-                  and hasattr(request, 'json') and request.json:
-                    request_csrf_token = request.json.get(self._csrf_name, '')
-
-            # Except Attribute error if JSON data is a list
-            except (BadRequest, AttributeError):
-                pass
+        # Look for the token cheapest-first. As per the Django middleware, the
+        # header makes AJAX easier and PUT and DELETE possible, and checking
+        # it first avoids reading and parsing the request body. A header
+        # token takes precedence over one in the body.
+        request_csrf_token = request.headers.get(self._csrf_header_name, '')
 
         if not request_csrf_token:
-            # As per the Django middleware, this makes AJAX easier and
-            # PUT and DELETE possible.
-            request_csrf_token = request.headers.get(self._csrf_header_name, '')
-
-        some_none = None in (request_csrf_token, server_csrf_token)
-        if some_none or not safe_str_cmp(request_csrf_token, server_csrf_token):
-            error = (REASON_BAD_TOKEN, request.path)
-            error = u'Forbidden ({0}): {1}'.format(*error)
-            current_app.logger.warning(error)
+            if request.is_json:
+                # Invalid JSON, or JSON that isn't an object, has no token.
+                data = request.get_json(silent=True)
+                if isinstance(data, dict):
+                    request_csrf_token = data.get(self._csrf_name, '')
+            else:
+                request_csrf_token = request.form.get(self._csrf_name, '')
+
+        # A missing token can be rejected outright; only a real comparison
+        # needs to be constant time.
+        if (not server_csrf_token or not request_csrf_token or
+                not safe_str_cmp(request_csrf_token, server_csrf_token)):
+            current_app.logger.warning(u'Forbidden (%s): %s',
+                                       REASON_BAD_TOKEN, request.path)
             raise Forbidden(description=REASON_BAD_TOKEN)
 
     def generate_new_token(self):
@@ -355,7 +457,8 @@ class SeaSurf(object):
         new_csrf_token = self._generate_token()
 
         session[self._csrf_name] = new_csrf_token
-        setattr(_app_ctx_stack.top, self._csrf_name, new_csrf_token)
+        g.setdefault('_seasurf', {})[self._csrf_name] = new_csrf_token
+        g._csrf_server_token = new_csrf_token
 
     def _should_use_token(self, view_func):
         '''
@@ -364,22 +467,42 @@ class SeaSurf(object):
 
         :param view_func: A view function.
         '''
-        if (hasattr(g, 'csrf_validation_checked') and
-            getattr(g, 'csrf_validation_checked')):
+        if g.get('csrf_validation_checked', False):
             return True
 
-        if view_func is None or self._type not in ('exempt', 'include'):
-            return False
+        # _before_request and _after_request both ask about the same view;
+        # only work it out once per request.
+        cached = g.get('_csrf_should_use_token')
+        if cached is not None and cached[0] is view_func:
+            return cached[1]
+
+        use_token = self._classify_view(view_func)
+        if use_token and self._exempt_urls_re is not None:
+            url = u'{0}{1}'.format(request.script_root, request.path)
+            use_token = self._exempt_urls_re.match(url) is None
+
+        g._csrf_should_use_token = (view_func, use_token)
+        return use_token
 
-        view = '{0}.{1}'.format(view_func.__module__, view_func.__name__)
-        if self._type == 'exempt' and view in self._exempt_views:
+    def _classify_view(self, view_func):
+        '''
+        Given a view function, determine whether the exempt or included views
+        call for validating requests to it. Memoized per instance, see
+        `__init__`.
+
+        :param view_func: A view function.
+        '''
+        if view_func is None or self._type not in ('exempt', 'include'):
             return False
 
-        if self._type == 'include' and view not in self._include_views:
+        if (self._type == 'exempt' and
+            _is_registered(view_func, self._exempt_views,
+                           self._exempt_view_locations)):
             return False
 
-        url = u'{0}{1}'.format(request.script_root, request.path)
-        if url.startswith(self._exempt_urls):
+        if (self._type == 'include' and
+            not _is_registered(view_func, self._include_views,
+                               self._include_view_locations)):
             return False
 
         return True
@@ -395,8 +518,8 @@ class SeaSurf(object):
         if self._should_use_token(view_func):
             return True
 
-        view = '{0}.{1}'.format(view_func.__module__, view_func.__name__)
-        if view in self._set_cookie_views:
+        if _is_registered(view_func, self._set_cookie_views,
+                          self._set_cookie_view_locations):
             return True
 
         return False
@@ -415,40 +538,44 @@ class SeaSurf(object):
         configuration.
         '''
 
+        # `g` belongs to the app context, which several requests may share,
+        # so drop whatever an earlier request loaded from its session or
+        # worked out about its view.
+        for key in ('_seasurf', '_csrf_server_token',
+                    '_csrf_should_use_token'):
+            g.pop(key, None)
+
         if self._csrf_disable:
             return  # don't validate for testing
 
-        server_csrf_token = session.get(self._csrf_name, None)
-        if not server_csrf_token:
-            setattr(_app_ctx_stack.top,
-                    self._csrf_name,
-                    self._generate_token())
-        else:
-            setattr(_app_ctx_stack.top, self._csrf_name, server_csrf_token)
-
         # Always set this to let the response know whether or not to set the
         # CSRF token.
-        _app_ctx_stack.top._view_func = \
-            current_app.view_functions.get(request.endpoint)
+        g._csrf_view_func = current_app.view_functions.get(request.endpoint)
+
+        # Safe methods are never validated, so leave the session untouched
+        # until the token is actually needed.
+        if request.method in _SAFE_METHODS:
+            return
+
+        self._load_token()
 
-        if request.method not in ('GET', 'HEAD', 'OPTIONS', 'TRACE'):
-            # Retrieve the view function based on the request endpoint and
-            # then compare it to the set of exempted views
-            if not self._should_use_token(_app_ctx_stack.top._view_func):
-                return
+        # Retrieve the view function based on the request endpoint and
+        # then compare it to the set of exempted views
+        if not self._should_use_token(g._csrf_view_func):
+            return
 
-            if self._skip_validation and self._skip_validation(request):
-                return
+        if self._skip_validation and self._skip_validation(request):
+            return
 
-            self.validate()
+        self.validate()
 
     def _after_request(self, response):
         '''
-        Checks if the `flask._app_ctx_object` object contains the CSRF token,
-        and if the view in question has CSRF protection enabled. If both,
-        goes on to check if a cookie needs to be set by verifying the cookie
-        presented by the request matches the CSRF token and the user has not
-        requested a token in a Jinja template.
+        Checks if `flask.g` records the view for this request, and if the view
+        in question has CSRF protection enabled. If both, goes on to check if
+        a cookie needs to be set by verifying the cookie presented by the
+        request matches the CSRF token and the user has not requested a token
+        in a Jinja template.
 
         If the token does not match or the user has requested a token,returns
         the response with a cookie containing the token. Otherwise we return
@@ -456,17 +583,14 @@ class SeaSurf(object):
 
         :param response: A Flask Response object.
         '''
-        if getattr(_app_ctx_stack.top, self._csrf_name, None) is None:
-            return response
-
-        _view_func = getattr(_app_ctx_stack.top, '_view_func', False)
+        _view_func = g.get('_csrf_view_func', False)
         if not (_view_func and self._should_set_cookie(_view_func)):
             return response
 
         # Don't apply set_cookie if the request included the cookie
         # and did not request a token (ie simple AJAX requests, etc)
-        csrf_cookie_matches = request.cookies.get(self._csrf_name, False) == getattr(_app_ctx_stack.top, self._csrf_name)
-        if csrf_cookie_matches and not getattr(_app_ctx_stack.top, 'csrf_token_requested', False):
+        csrf_cookie_matches = request.cookies.get(self._csrf_name, False) == self._load_token()
+        if csrf_cookie_matches and not g.get('csrf_token_requested', False):
             return response
 
         if self._disable_cookie and self._disable_cookie(response):
@@ -482,19 +606,12 @@ class SeaSurf(object):
         :param response: A Flask Response object.
         '''
 
-        csrf_token = getattr(_app_ctx_stack.top, self._csrf_name)
+        csrf_token = g._seasurf[self._csrf_name]
         if session.get(self._csrf_name) != csrf_token:
             session[self._csrf_name] = csrf_token
-        expires_at = datetime.utcnow() + self._csrf_timeout
-        response.set_cookie(self._csrf_name,
-                            csrf_token,
-                            max_age=self._csrf_timeout,
-                            expires=calendar.timegm(expires_at.utctimetuple()),
-                            secure=self._csrf_secure,
-                            httponly=self._csrf_httponly,
-                            path=self._csrf_path,
-                            domain=self._csrf_domain,
-                            samesite=self._csrf_samesite)
+        max_age = self._csrf_timeout_seconds
+        self._set_cookie_fast(response, csrf_token, max_age,
+                              int(time.time()) + max_age)
         response.vary.add('Cookie')
 
     def _get_token(self):
@@ -507,20 +624,32 @@ class SeaSurf(object):
         # will only pass the Set-Cookie header when a request needs a token generated
         # generated or has requested one in it's template.
         # See https://github.com/django/django/blob/86de930f/django/middleware/csrf.py#L74
-        _app_ctx_stack.top.csrf_token_requested = True
+        g.csrf_token_requested = True
 
-        token = getattr(_app_ctx_stack.top, self._csrf_name, None)
+        if self._csrf_disable or not has_request_context():
+            token = g.get('_seasurf', {}).get(self._csrf_name, None)
+        else:
+            token = self._load_token()
         if isinstance(token, bytes):
             return token.decode('utf8')
         return token
 
+    def _load_token(self):
+        '''
+        Returns the CSRF token for the current request, reading it from the
+        session, or generating a new one, the first time it is needed.
+        '''
+        tokens = g.setdefault('_seasurf', {})
+        csrf_token = tokens.get(self._csrf_name, None)
+        if csrf_token is None:
+            server_csrf_token = session.get(self._csrf_name, None)
+            g._csrf_server_token = server_csrf_token
+            csrf_token = server_csrf_token or self._generate_token()
+            tokens[self._csrf_name] = csrf_token
+        return csrf_token
+
     def _generate_token(self):
         '''
-        Generates a token using PEP 506 secrets module (if available), or falling back to a SHA1-salted random.
+        Generates a token using the PEP 506 secrets module.
         '''
-        if secrets:
-            # use PEP 506 secrets module
-            return secrets.token_hex()
-        else:
-            salt = str(random.randrange(0, _MAX_CSRF_KEY)).encode('utf-8')
-            return hashlib.sha1(salt).hexdigest()
+        return token_hex()
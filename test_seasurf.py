@@ -1,10 +1,12 @@
 from __future__ import with_statement
 
+import functools
 import mock
 import unittest
 
-from flask import Flask, render_template_string, request
-from flask_seasurf import SeaSurf, REASON_NO_REQUEST
+from flask import Flask, render_template_string, request, session
+from flask.views import MethodView
+from flask_seasurf import SeaSurf, REASON_NO_REQUEST, _same_origin
 from werkzeug.exceptions import Forbidden
 from werkzeug.http import parse_cookie
 
@@ -193,6 +195,23 @@ class SeaSurfTestCase(BaseTestCase):
             rv = client.post(u'/bar/\xf8', headers=headers)
             self.assertEqual(rv.status_code, 200, rv)
 
+    def test_header_token_takes_precedence(self):
+        with self.app.test_client() as client:
+            with client.session_transaction() as sess:
+                token = self.csrf._generate_token()
+                sess[self.csrf._csrf_name] = token
+
+            data = {self.csrf._csrf_name: token}
+            headers = {
+                self.csrf._csrf_header_name: self.csrf._generate_token(),
+            }
+
+            rv = client.post('/bar', data=data, headers=headers)
+            self.assertEqual(rv.status_code, 403, rv)
+
+            rv = client.post('/bar', json=data, headers=headers)
+            self.assertEqual(rv.status_code, 403, rv)
+
     def test_token_in_form_data(self):
         with self.app.test_client() as client:
             with client.session_transaction() as sess:
@@ -236,6 +255,19 @@ class SeaSurfTestCase(BaseTestCase):
                              headers=headers)
             self.assertEqual(rv.status_code, 200, rv)
 
+    def test_same_origin(self):
+        self.assertTrue(_same_origin('https://www.example.com/foo?bar#baz',
+                                     'https://WWW.example.com/'))
+        self.assertTrue(_same_origin('https://user:pw@[::1]:8443/foo',
+                                     'https://[::1]:8443'))
+        self.assertFalse(_same_origin('https://www.example.com/',
+                                      'http://www.example.com/'))
+        self.assertFalse(_same_origin('https://www.example.com:8443/',
+                                      'https://www.example.com/'))
+        self.assertFalse(_same_origin('https://www.evil.com/www.example.com',
+                                      'https://www.example.com/'))
+        self.assertFalse(_same_origin('null', 'null'))
+
     def test_cannot_validate_without_request(self):
         with self.assertRaises(Forbidden) as ex:
             self.csrf.validate()
@@ -243,14 +275,8 @@ class SeaSurfTestCase(BaseTestCase):
         self.assertEqual(str(ex.exception), expected_exception_message)
 
     def test_secrets(self):
-        try:
-            import secrets
-            with mock.patch('secrets.token_hex', return_value='3b0b5a5c1de3c2ed'):
-                self.assertEqual(self.csrf._generate_token(), '3b0b5a5c1de3c2ed')
-        except ImportError:
-            with mock.patch('random.randrange', return_value=4123476):
-                with mock.patch('random.SystemRandom.randrange', return_value=4123476):
-                    self.assertEqual(self.csrf._generate_token(), 'a22372bcac286ccf659ddda312e6311149edd6b0')
+        with mock.patch('flask_seasurf.token_hex', return_value='3b0b5a5c1de3c2ed'):
+            self.assertEqual(self.csrf._generate_token(), '3b0b5a5c1de3c2ed')
 
 
 class SeaSurfTestCaseExemptViews(BaseTestCase):
@@ -278,6 +304,39 @@ class SeaSurfTestCaseExemptViews(BaseTestCase):
         def bar():
             return 'foo'
 
+        def wrapper(view):
+            @functools.wraps(view)
+            def wrapped(*args, **kwargs):
+                return view(*args, **kwargs)
+            return wrapped
+
+        @app.route('/baz', methods=['POST'])
+        @wrapper
+        @csrf.exempt
+        def baz():
+            return 'baz'
+
+        def copy_wrapper(view):
+            def wrapped(*args, **kwargs):
+                return view(*args, **kwargs)
+            wrapped.__name__ = view.__name__
+            wrapped.__module__ = view.__module__
+            return wrapped
+
+        @app.route('/quz', methods=['POST'])
+        @copy_wrapper
+        @csrf.exempt
+        def quz():
+            return 'quz'
+
+        class ExemptView(MethodView):
+            def post(self):
+                return 'exempt_view'
+
+        csrf.exempt(ExemptView.as_view('exempt_view'))
+        app.add_url_rule('/exempt_view',
+                         view_func=ExemptView.as_view('exempt_view'))
+
     def test_exempt_view(self):
         with self.app.test_client() as c:
             rv = c.post('/foo')
@@ -285,6 +344,18 @@ class SeaSurfTestCaseExemptViews(BaseTestCase):
             cookie = get_cookie(rv, self.csrf._csrf_name)
             self.assertEqual(cookie, None)
 
+    def test_exempt_wrapped_view(self):
+        rv = self.app.test_client().post('/baz')
+        self.assertIn(b('baz'), rv.data)
+
+    def test_exempt_copied_name_view(self):
+        rv = self.app.test_client().post('/quz')
+        self.assertIn(b('quz'), rv.data)
+
+    def test_exempt_method_view(self):
+        rv = self.app.test_client().post('/exempt_view')
+        self.assertIn(b('exempt_view'), rv.data)
+
     def test_token_validation(self):
         # should produce a logger warning
         rv = self.app.test_client().post('/bar')
@@ -371,6 +442,15 @@ class SeaSurfTestCaseExemptUrls(BaseTestCase):
             cookie = get_cookie(rv, self.csrf._csrf_name)
             self.assertEqual(cookie, None)
 
+    def test_overlapping_exempt_urls(self):
+        self.csrf.exempt_urls(('/foo/baz', '/foo', '/foo/quz'))
+
+        rv = self.app.test_client().post('/foo/quz')
+        self.assertIn(b('bar'), rv.data)
+
+        rv = self.app.test_client().post('/bar')
+        self.assertIn(b('403 Forbidden'), rv.data)
+
     def test_token_validation(self):
         with self.app.test_client() as c:
             # should produce a logger warning
@@ -576,6 +656,26 @@ class SeaSurfTestManualValidation(unittest.TestCase):
             csrf.validate()
             return 'bar'
 
+        @csrf.exempt
+        @app.route('/logout', methods=['POST'])
+        def logout():
+            session.clear()
+            csrf.validate()
+            return 'bar'
+
+    def test_manual_validation_uses_current_session(self):
+        with self.app.test_client() as client:
+            with client.session_transaction() as sess:
+                token = self.csrf._generate_token()
+                sess[self.csrf._csrf_name] = token
+
+            headers = {self.csrf._csrf_header_name: token}
+            rv = client.post('/manual', headers=headers)
+            self.assertEqual(rv.status_code, 200, rv)
+
+            rv = client.post('/logout', headers=headers)
+            self.assertEqual(rv.status_code, 403, rv)
+
     def test_can_manually_validate_exempt_views(self):
         with self.app.test_client() as c:
             rv = c.post('/manual')
@@ -596,6 +696,7 @@ class SeaSurfTestCaseSave(BaseTestCase):
         def after_request(response):
             from flask import session
             response.headers['X-Session-Modified'] = str(session.modified)
+            response.headers['X-Session-Accessed'] = str(session.accessed)
             return response
 
         csrf = SeaSurf()
@@ -609,6 +710,11 @@ class SeaSurfTestCaseSave(BaseTestCase):
         def foo():
             return 'bar'
 
+        @csrf.exempt
+        @app.route('/exempt', methods=['GET'])
+        def exempt():
+            return 'exempt'
+
     def test_save(self):
         with self.app.test_client() as client:
             rv = client.get('/foo')
@@ -619,6 +725,12 @@ class SeaSurfTestCaseSave(BaseTestCase):
             self.assertIn(b('bar'), rv.data)
             self.assertEqual(rv.headers['X-Session-Modified'], 'False')
 
+    def test_exempt_get_does_not_access_session(self):
+        with self.app.test_client() as client:
+            rv = client.get('/exempt')
+            self.assertIn(b('exempt'), rv.data)
+            self.assertEqual(rv.headers['X-Session-Accessed'], 'False')
+
 
 class SeaSurfTestCaseReferer(BaseTestCase):
     def setUp(self):
@@ -804,6 +916,69 @@ class SeaSurfTestCaseGenerateNewToken(BaseTestCase):
                           'CSRF cookie should have been set to the new token')
 
 
+class SeaSurfTestCaseSharedAppContext(BaseTestCase):
+    '''
+    Requests made while an application context is already pushed share it.
+    Each request must still use the token from its own session.
+    '''
+    def setUp(self):
+        app = Flask(__name__)
+        app.debug = True
+        app.secret_key = '1234'
+        self.app = app
+
+        csrf = SeaSurf()
+        csrf._csrf_disable = False
+        self.csrf = csrf
+
+        self.csrf.init_app(app)
+
+        @app.route('/form', methods=['GET'])
+        def form():
+            return render_template_string('{{ csrf_token() }}')
+
+        @app.route('/bar', methods=['POST'])
+        def bar():
+            return 'foo'
+
+        @app.route('/exempt/baz', methods=['POST'])
+        @app.route('/baz', methods=['POST'])
+        def baz():
+            return 'baz'
+
+    def test_exempt_url_checked_per_request(self):
+        self.csrf.exempt_urls(('/exempt',))
+
+        with self.app.app_context():
+            client = self.app.test_client()
+            rv = client.post('/exempt/baz')
+            self.assertEqual(rv.status_code, 200, rv)
+
+            rv = client.post('/baz')
+            self.assertEqual(rv.status_code, 403, rv)
+
+    def test_token_from_own_session(self):
+        with self.app.app_context():
+            client = self.app.test_client()
+            token = client.get('/form').data.decode('utf-8')
+
+            rv = client.post('/bar', headers={self.csrf._csrf_header_name: token})
+            self.assertEqual(rv.status_code, 200, rv)
+
+    def test_token_not_shared_between_sessions(self):
+        client_a = self.app.test_client()
+        token = client_a.get('/form').data.decode('utf-8')
+        headers = {self.csrf._csrf_header_name: token}
+
+        with self.app.app_context():
+            rv = client_a.post('/bar', headers=headers)
+            self.assertEqual(rv.status_code, 200, rv)
+
+            client_b = self.app.test_client()
+            rv = client_b.post('/bar', headers=headers)
+            self.assertEqual(rv.status_code, 403, rv)
+
+
 def suite():
     suite = unittest.TestSuite()
 
@@ -819,6 +994,7 @@ def suite():
     suite.addTest(unittest.TestLoader().loadTestsFromTestCase(SeaSurfTestCaseReferer))
     suite.addTest(unittest.TestLoader().loadTestsFromTestCase(SeaSurfTestManualValidation))
     suite.addTest(unittest.TestLoader().loadTestsFromTestCase(SeaSurfTestCaseGenerateNewToken))
+    suite.addTest(unittest.TestLoader().loadTestsFromTestCase(SeaSurfTestCaseSharedAppContext))
     return suite
 
 